@@ -1,14 +1,18 @@
+import asyncio
 import logging
-from datetime import date, timedelta
-import time
+from datetime import date, datetime, time as dt_time, timedelta
+from zoneinfo import ZoneInfoNotFoundError
 import requests
-import icalendar
+from requests.adapters import HTTPAdapter
+from itertools import groupby
+from operator import itemgetter
 import sqlite3
-from schedule import every, run_pending
-from telegram import Bot, Update
-from telegram.ext import CommandHandler, Application, ContextTypes
-import traceback
+import threading
+from telegram import Update
+from telegram.ext import AIORateLimiter, CommandHandler, Application, ContextTypes, Defaults
+from tzlocal import get_localzone
 import os
+import re
 from dotenv import load_dotenv
 
 # Configure logging
@@ -26,108 +30,279 @@ TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ICAL_URL = os.getenv("ICAL_URL")
 CHAT_ID = os.getenv("CHAT_ID")
 ICAL_FILE = "tvmaze_followed.ics"
+DEBUG_DUMP_ICS = os.getenv("DEBUG_DUMP_ICS")
 DB_FILE = "tv_notifications.db"
+SEND_CONCURRENCY = 25
+VACUUM_INTERVAL = timedelta(days=30)
+SCHEMA_VERSION = 1
+
+# Shared HTTP session so calendar downloads reuse pooled connections
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "tv_notifier/1.0"})
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=4))
+
+# (date, rows) of the last notification query, reused for retries on the same day
+_notification_cache = None
+
+def _open_db():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+    # WAL is persistent in the database file; the rest are per-connection
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-64000")
+    return conn
+
+# One connection shared by the handlers and the schedule update thread
+DB = _open_db()
+DB_LOCK = threading.Lock()
 
 def init_db():
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute('''CREATE TABLE IF NOT EXISTS events
-                         (uid TEXT PRIMARY KEY, 
-                          summary TEXT,
-                          start_date DATE)''')
+        with DB_LOCK:
+            cursor = DB.cursor()
+            cursor.execute('''CREATE TABLE IF NOT EXISTS events
+                             (uid TEXT PRIMARY KEY, 
+                              summary TEXT,
+                              start_date DATE,
+                              show TEXT,
+                              season TEXT,
+                              episode TEXT)''')
+
+            # Add and backfill the split episode columns on older databases
+            schema_version = cursor.execute("PRAGMA user_version").fetchone()[0]
+            if schema_version < SCHEMA_VERSION:
+                columns = {row[1] for row in cursor.execute("PRAGMA table_info(events)")}
+                with DB:
+                    for column in ("show", "season", "episode"):
+                        if column not in columns:
+                            cursor.execute(f"ALTER TABLE events ADD COLUMN {column} TEXT")
+                    rows = cursor.execute("SELECT uid, summary FROM events").fetchall()
+                    cursor.executemany(
+                        "UPDATE events SET show = ?, season = ?, episode = ? WHERE uid = ?",
+                        [(*_split_summary(summary), uid) for uid, summary in rows])
+                    cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+            # Covering index for the daily and weekly date lookups
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_events_schedule
+                             ON events (start_date, show, season, episode, summary, uid)''')
+            cursor.execute('''CREATE TABLE IF NOT EXISTS meta
+                             (key TEXT PRIMARY KEY,
+                              value TEXT)''')
+            cursor.execute("ANALYZE")
         logging.info("Database initialized successfully")
-        conn.close()
-    except Exception as e:
-        logging.error(f"Database initialization failed: {str(e)}")
-        traceback.print_exc()
+    except Exception:
+        logging.exception("Database initialization failed")
+
+def _unfold_lines(lines):
+    # Join RFC 5545 continuation lines onto the line they extend
+    current = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t"):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+def _split_summary(summary):
+    # "Show: 02x05" -> ("Show", "02", "05"); season/episode stay None without an "x"
+    if ": " not in summary:
+        return None, None, None
+    show, episode_info = summary.split(": ", 1)
+    if "x" not in episode_info:
+        return show, None, None
+    season, episode = episode_info.split("x", 1)
+    return show, season, episode
+
+def _unescape_text(value):
+    return re.sub(r"\\(.)", lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+def _iter_events(lines):
+    # Yield an events row for each VEVENT without building a full calendar
+    depth = 0
+    uid = summary = start_date = None
+    for line in _unfold_lines(lines):
+        name, sep, value = line.partition(":")
+        if not sep:
+            continue
+        name = name.split(";", 1)[0].upper()
+
+        if name == "BEGIN":
+            if value.upper() == "VEVENT":
+                depth = 1
+                uid = summary = start_date = None
+            elif depth:
+                depth += 1  # Nested component such as VALARM
+        elif name == "END" and depth:
+            depth -= 1
+            if depth == 0 and uid and summary is not None and start_date:
+                yield (uid, summary, start_date, *_split_summary(summary))
+        elif depth == 1:
+            if name == "UID":
+                uid = value
+            elif name == "SUMMARY":
+                summary = _unescape_text(value)
+            elif name == "DTSTART":
+                start_date = datetime.strptime(value[:8], "%Y%m%d").date().isoformat()
+
+def _delete_stale_events(cursor):
+    # Drop episodes that aired over a week ago
+    cutoff = date.today() - timedelta(days=7)
+    cursor.execute("DELETE FROM events WHERE start_date < ?", (cutoff.isoformat(),))
 
 def update_schedule():
+    global _notification_cache
     try:
-        # Download iCal file
-        response = requests.get(ICAL_URL, timeout=30)
+        # Download iCal file, skipping the update if it hasn't changed
+        with DB_LOCK:
+            cursor = DB.cursor()
+            cursor.execute("SELECT key, value FROM meta WHERE key IN ('etag', 'last_modified')")
+            validators = dict(cursor.fetchall())
+        headers = {}
+        if "etag" in validators:
+            headers["If-None-Match"] = validators["etag"]
+        if "last_modified" in validators:
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        response = SESSION.get(ICAL_URL, headers=headers, timeout=30)
+        if response.status_code == 304:
+            logging.info("iCal file not modified, skipping update")
+            with DB_LOCK, DB:
+                _delete_stale_events(DB.cursor())
+            return
         response.raise_for_status()
 
-        with open(ICAL_FILE, "wb") as f:
-            f.write(response.content)
         logging.info("iCal file downloaded successfully")
-        
-        # Parse iCal and update database
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
-        with open(ICAL_FILE, "rb") as f:
-            cal = icalendar.Calendar.from_ical(f.read())
-            for event in cal.walk("vevent"):
-                uid = event["uid"]
-                start_date = event["dtstart"].dt.date().isoformat()
-                summary = event["summary"]
-                
-                try:
-                    cursor.execute(
-                        """INSERT OR IGNORE INTO events 
-                           VALUES (?, ?, ?)""", 
-                        (uid, summary, start_date))
-                    conn.commit()
-                except sqlite3.Error as e:
-                    logging.warning(f"Failed to insert event {uid}: {str(e)}")
-
-        conn.close()
-        logging.info("Database updated with new events")
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Failed to download iCal file: {str(e)}")
-    except Exception as e:
-        logging.error(f"Error updating schedule: {str(e)}")
-        traceback.print_exc()
+        if DEBUG_DUMP_ICS:
+            with open(ICAL_FILE, "wb") as f:
+                f.write(response.content)
 
-def send_notifications():
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
+        # Parse before taking the lock so readers aren't held up by it
+        rows = list(_iter_events(response.content.decode("utf-8").split("\n")))
 
-        # Get events premiering tomorrow
-        tomorrow = date.today() + timedelta(days=1)
+        # Update database in a single transaction
+        with DB_LOCK:
+            try:
+                with DB:
+                    cursor = DB.cursor()
+                    cursor.executemany(
+                        """INSERT OR IGNORE INTO events
+                           (uid, summary, start_date, show, season, episode)
+                           VALUES (?, ?, ?, ?, ?, ?)""",
+                        rows)
+                    _delete_stale_events(cursor)
+                    _notification_cache = None  # Re-query against the fresh calendar
+                    # Remember validators only once the events are stored
+                    if "ETag" in response.headers:
+                        cursor.execute(
+                            "INSERT OR REPLACE INTO meta VALUES ('etag', ?)",
+                            (response.headers["ETag"],))
+                    if "Last-Modified" in response.headers:
+                        cursor.execute(
+                            "INSERT OR REPLACE INTO meta VALUES ('last_modified', ?)",
+                            (response.headers["Last-Modified"],))
+            except sqlite3.Error:
+                logging.warning("Failed to insert events", exc_info=True)
+                return
+
+            # Reclaim space from deleted events about once a month
+            try:
+                cursor = DB.cursor()
+                cursor.execute("SELECT value FROM meta WHERE key = 'last_vacuum'")
+                row = cursor.fetchone()
+                if row is None or date.fromisoformat(row[0]) <= date.today() - VACUUM_INTERVAL:
+                    cursor.execute("VACUUM")
+                    with DB:
+                        cursor.execute(
+                            "INSERT OR REPLACE INTO meta VALUES ('last_vacuum', ?)",
+                            (date.today().isoformat(),))
+            except sqlite3.Error:
+                logging.warning("Failed to vacuum database", exc_info=True)
+
+        logging.info("Database updated with new events")
+    except requests.exceptions.RequestException:
+        logging.exception("Failed to download iCal file")
+    except Exception:
+        logging.exception("Error updating schedule")
+
+async def update_schedule_job(context: ContextTypes.DEFAULT_TYPE):
+    # Run the blocking download off the event loop
+    await asyncio.to_thread(update_schedule)
+
+def _fetch_reminders(today):
+    # Runs in a worker thread so waiting on DB_LOCK never blocks the event loop.
+    # The cache is read and written under the lock so it can't outlive an update.
+    global _notification_cache
+    with DB_LOCK:
+        if _notification_cache is not None and _notification_cache[0] == today:
+            return _notification_cache[1]
+        tomorrow = today + timedelta(days=1)
+        cursor = DB.cursor()
         cursor.execute(
-            """SELECT uid, summary 
-               FROM events 
-               WHERE start_date = ?""", 
+            """SELECT uid,
+                      CASE WHEN show IS NOT NULL
+                           THEN 'Reminder: ' || show || char(10) ||
+                                '🔴 Episode: ' || substr(summary, instr(summary, ': ') + 2) ||
+                                ' airs tomorrow!'
+                           ELSE 'Reminder: ' || summary || ' airs tomorrow!'
+                      END
+               FROM events
+               WHERE start_date = ?""",
             (tomorrow.isoformat(),)
         )
-        upcoming_events = cursor.fetchall()
+        _notification_cache = (today, cursor.fetchall())
+        return _notification_cache[1]
+
+async def send_notifications(context: ContextTypes.DEFAULT_TYPE):
+    try:
+        # Get reminders for events premiering tomorrow, reusing today's query result if any
+        upcoming_events = await asyncio.to_thread(_fetch_reminders, date.today())
 
         if upcoming_events:
-            bot = Bot(token=TELEGRAM_BOT_TOKEN)
-            for uid, summary in upcoming_events:
-                show_parts = summary.split(": ")
-                if len(show_parts) == 2:
-                    show_name = show_parts[0]
-                    episode = show_parts[1]
-                    message_text = f"Reminder: {show_name}\n🔴 Episode: {episode} airs tomorrow!"
+            # Send reminders concurrently, capping in-flight requests below Telegram's limit
+            semaphore = asyncio.Semaphore(SEND_CONCURRENCY)
+
+            async def send(message_text):
+                async with semaphore:
+                    return await context.bot.send_message(chat_id=context.job.chat_id, text=message_text)
+
+            results = await asyncio.gather(
+                *(send(message_text) for _, message_text in upcoming_events),
+                return_exceptions=True
+            )
+            for (uid, _), result in zip(upcoming_events, results):
+                if isinstance(result, Exception):
+                    logging.error(f"Failed to send notification for {uid}", exc_info=result)
                 else:
-                    message_text = f"Reminder: {summary} airs tomorrow!"
-                
-                try:
-                    bot.send_message(
-                        chat_id=CHAT_ID,
-                        text=message_text
-                    )
                     logging.info(f"Notification sent for {uid}")
-                except Exception as e:
-                    logging.error(f"Failed to send notification for {uid}: {str(e)}")
 
-        conn.close()
         logging.info("Notifications sent successfully")
-    except sqlite3.Error as e:
-        logging.error(f"Database error during notifications: {str(e)}")
-    except Exception as e:
-        logging.error(f"Error sending notifications: {str(e)}")
-        traceback.print_exc()
+    except sqlite3.Error:
+        logging.exception("Database error during notifications")
+    except Exception:
+        logging.exception("Error sending notifications")
+
+def _fetch_weekly_events(first_date, last_date):
+    # Runs in a worker thread so waiting on DB_LOCK never blocks the event loop
+    with DB_LOCK:
+        cursor = DB.cursor()
+        cursor.execute(
+            """SELECT start_date, show, season, episode
+               FROM events
+               WHERE start_date BETWEEN ? AND ?
+                 AND season IS NOT NULL
+               ORDER BY start_date, show, season, episode""",
+            (first_date, last_date)
+        )
+        return cursor.fetchall()
 
 async def send_weekly_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-
         # Get today's date
         today = date.today()
         logging.info(f"Today's date: {today}")
@@ -135,16 +310,12 @@ async def send_weekly_schedule(update: Update, context: ContextTypes.DEFAULT_TYP
         # Calculate the end of the week (Sunday)
         sunday = today + timedelta(days=(6 - today.weekday()) % 7)
         logging.info(f"Sunday date: {sunday}")
+        today_iso = today.isoformat()
+        sunday_iso = sunday.isoformat()
+
+        # Get this week's episodes ordered by day and show
+        events = await asyncio.to_thread(_fetch_weekly_events, today_iso, sunday_iso)
 
-        # Get all events between today and Sunday
-        cursor.execute(
-            """SELECT uid, summary, start_date 
-               FROM events 
-               WHERE start_date BETWEEN ? AND ?""",
-            (today.isoformat(), sunday.isoformat())
-        )
-        
-        events = cursor.fetchall()
         logging.info(f"Found {len(events)} events in database")
 
         if not events:
@@ -155,74 +326,36 @@ async def send_weekly_schedule(update: Update, context: ContextTypes.DEFAULT_TYP
             logging.info("No events found for this week")
             return
 
-        # Organize events by date and show title
-        weekly_schedule = {}
-        for uid, summary, start_date_str in events:
-            try:
-                start_date = date.fromisoformat(start_date_str)
-                if start_date < today:
-                    continue  # Skip events that have already aired
-
-                # Extract show title and episode info
-                title, episode_info = summary.split(": ")
-                season_episode = episode_info.split("x")
-                if len(season_episode) != 2:
-                    continue  # Skip invalid format
-
-                season = season_episode[0]
-                episode = season_episode[1]
-
-                # Group by date and show title
-                if start_date not in weekly_schedule:
-                    weekly_schedule[start_date] = {}
-                if title not in weekly_schedule[start_date]:
-                    weekly_schedule[start_date][title] = []
-                weekly_schedule[start_date][title].append(episode)
-
-            except Exception as e:
-                logging.error(f"Error processing event {uid}: {str(e)}")
-                continue
-
-        if not weekly_schedule:
-            await context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text="No upcoming shows scheduled for this week."
-            )
-            logging.info("No future events found")
-            return
-
         # Create message with formatted schedule
-        message = "📅 This week's TV schedule (from today to Sunday):\n\n"
-        for day in sorted(weekly_schedule.keys()):
-            day_str = day.strftime("%A, %B %d")
-            message += f"👉 {day_str}:\n"
-            for show_title, episodes in weekly_schedule[day].items():
-                message += f"- {show_title} (Season {season})\n"
-                for episode in episodes:
-                    message += f"  • Episode {episode.lstrip('0')}\n"
-            message += "\n"
+        parts = ["📅 This week's TV schedule (from today to Sunday):", ""]
+        # Rows are already sorted, so each ISO date is parsed once per day
+        for start_date, day_events in groupby(events, key=itemgetter(0)):
+            day_str = date.fromisoformat(start_date).strftime("%A, %B %d")
+            parts.append(f"👉 {day_str}:")
+            for (show_title, season), episodes in groupby(day_events, key=itemgetter(1, 2)):
+                parts.append(f"- {show_title} (Season {season})")
+                for _, _, _, episode in episodes:
+                    parts.append(f"  • Episode {episode.lstrip('0')}")
+            parts.append("")
 
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
-            text=message
+            text="\n".join(parts)
         )
         logging.info("Weekly schedule sent successfully")
 
-    except sqlite3.Error as e:
-        logging.error(f"Database error during weekly schedule: {str(e)}")
+    except sqlite3.Error:
+        logging.exception("Database error during weekly schedule")
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Error fetching weekly schedule. Please try again later."
         )
-    except Exception as e:
-        logging.error(f"Error sending weekly schedule: {str(e)}")
-        traceback.print_exc()
+    except Exception:
+        logging.exception("Error sending weekly schedule")
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text="Error processing your request. Please try again later."
         )
-    finally:
-        conn.close()
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -237,40 +370,64 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
                  f"• /start - Check bot status"
         )
         logging.info("Start command received")
-    except Exception as e:
-        logging.error(f"Error in start command: {str(e)}")
-        traceback.print_exc()
+    except Exception:
+        logging.exception("Error in start command")
 
 
 def main():
     try:
+        # Parse the chat id once so every send gets an int
+        if not CHAT_ID:
+            logging.error("CHAT_ID is not set; notifications cannot be delivered")
+            return
+        try:
+            chat_id = int(CHAT_ID)
+        except ValueError:
+            logging.error(f"CHAT_ID={CHAT_ID!r} is not a numeric Telegram chat id")
+            return
+
+        # Schedule in a real zone so the daily job follows DST changes
+        try:
+            timezone = get_localzone()
+        except (ZoneInfoNotFoundError, ValueError):
+            logging.exception("Could not determine the local time zone from TZ or the system settings")
+            return
+
         # Initialize components
         init_db()
         update_schedule()
 
         # Create the Application and pass it your bot token
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        application = (
+            Application.builder()
+            .token(TELEGRAM_BOT_TOKEN)
+            .rate_limiter(AIORateLimiter())
+            .defaults(Defaults(tzinfo=timezone))
+            .build()
+        )
 
         # Add handler for the weekly command
         application.add_handler(CommandHandler('weekly', send_weekly_schedule))
         application.add_handler(CommandHandler('start', start_command))
         # Schedule jobs
-        every(30).days.do(update_schedule)
-        every().day.at("08:00").do(send_notifications)
+        application.job_queue.run_repeating(
+            update_schedule_job,
+            interval=timedelta(days=30),
+            first=timedelta(days=30)
+        )
+        application.job_queue.run_daily(
+            send_notifications,
+            time=dt_time(hour=8, minute=0),
+            chat_id=chat_id
+        )
 
-        # Run the bot
+        # Run the bot and its job queue
         application.run_polling()
 
-        # Run scheduler in parallel
-        while True:
-            run_pending()
-            time.sleep(1)
-
     except KeyboardInterrupt:
         logging.info("Service stopped by user")
-    except Exception as e:
-        logging.error(f"Main loop error: {str(e)}")
-        traceback.print_exc()
+    except Exception:
+        logging.exception("Main loop error")
 
 if __name__ == "__main__":
     main()